@@ -2,23 +2,28 @@
 Script for managing Prefect deployments based on Git commits and file changes. It provides functions to create and delete deployments based on modified files.
 
 The script performs the following tasks:
-- Retrieves the current Git branch and the commit hashes between the main branch and the current branch.
-- Retrieves the modified files in each commit.
-- Retrieves current Prefect deployments.
+- Retrieves the current Git branch through a persistent `git cat-file` process.
+- Retrieves the modified files in each commit between the main branch and the current branch with a single `git log` call.
+- Retrieves current Prefect deployments, concurrently with the modified files.
+- Squashes the operations of each modified file across the commits into a single operation, skipping
+  deployment scripts whose content did not change.
 - Visits each modified file and performs deployment operations based on the file path and operation.
-  - If the modified file is in the 'prefect/flows/deployments/' directory and the operation is 'A', 'M', 'R', or 'C', it creates a deployment from the file.
+  - If the modified file is in the 'prefect/flows/deployments/' directory and the operation is 'A', 'M', 'R', or 'C', it builds a deployment from the file.
   - If the modified file is in the 'prefect/flows/deployments/' directory and the operation is 'D', it deletes the corresponding deployment.
+- Deletes the deployments concurrently, then applies all the built deployments concurrently.
 """
 
 import asyncio
+import contextlib
 import logging
 import os
+import runpy
 import subprocess
-from typing import Dict, List
+import sys
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
-from packaging import version
-
-from prefect import __version__
 from prefect.deployments import Deployment
 from prefect.settings import PREFECT_API_KEY, PREFECT_API_URL
 
@@ -26,141 +31,474 @@ logging.basicConfig()
 logger = logging.getLogger("Automatic Prefect Deployment")
 logger.setLevel(logging.INFO)
 
+DEPLOYMENTS_DIRECTORY = (
+    Path(__file__).resolve().parents[2] / "prefect" / "flows" / "deployments"
+)
 
-if version.parse(__version__) >= version.parse("2.10"):
-    from prefect.client.orchestration import get_client
+# Deployment scripts are executed in this interpreter, so make their `templates` import
+# resolvable and import it (and Prefect with it) only once for all of them.
+sys.path.insert(0, str(DEPLOYMENTS_DIRECTORY))
+import templates  # noqa: E402
+
+# Deployment scripts or deployments that failed to be created or applied.
+failed_deployments: List[str] = []
+# Ids and names of the deployments to delete once all modified files are visited.
+pending_deletions: List[Tuple[str, str]] = []
+
+# Maximum number of deployments applied to the Prefect API at the same time.
+MAX_CONCURRENT_APPLIES = 8
 
-    async def get_prefect_deployments() -> List[Deployment]:
-        """Retrieve a list of Prefect deployments."""
-        async with get_client() as client:
-            deployments = await client.read_deployments()
+# Modified files under this path are deployment scripts.
+DEPLOYMENTS_PREFIX = "prefect/flows/deployments/"
+# File operations for which a deployment is created from the modified file.
+CREATE_OPERATIONS = frozenset("AMRC")
+
+
+try:
+    from prefect.client.orchestration import get_client
 
-            return deployments
+    def get_prefect_client():
+        """Return a client for the Prefect API."""
+        return get_client()
 
-else:
+except ImportError:
     from prefect.client import OrionClient
 
-    async def get_prefect_deployments() -> List[Deployment]:
-        """Retrieve a list of Prefect deployments."""
-        async with OrionClient(
-            api=PREFECT_API_URL.value(), api_key=PREFECT_API_KEY.value()
-        ) as client:
-            deployments = await client.read_deployments()
+    def get_prefect_client():
+        """Return a client for the Prefect API."""
+        return OrionClient(api=PREFECT_API_URL.value(), api_key=PREFECT_API_KEY.value())
 
-            return deployments
 
+async def get_prefect_deployments(client) -> List[Deployment]:
+    """
+    Retrieve a list of Prefect deployments.
+
+    Args:
+        client: The Prefect API client.
 
-def create_deployment(file_name: str) -> None:
+    Returns:
+        List[Deployment]: The Prefect deployments.
     """
-    Create a deployment from the specified file_name.
+    deployments = await client.read_deployments()
+
+    return deployments
+
+
+@contextlib.contextmanager
+def working_directory(path: Path) -> Iterator[None]:
+    """
+    Change the working directory for the duration of the context.
 
     Args:
-        file_name (str): The file_name to the deployment script.
+        path (Path): The working directory to use.
+    """
+    previous_directory = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_directory)
 
-    Raises:
-        subprocess.CalledProcessError: If the deployment creation fails.
+
+def create_deployment(file_path: Path) -> None:
+    """
+    Create a deployment from the specified file_path.
+
+    The deployment script is executed in the current interpreter, and must be run from
+    `DEPLOYMENTS_DIRECTORY` (see `main()`). If it fails or exits with a non-zero code, the
+    error is logged and the file_path is added to `failed_deployments`, so that the
+    remaining deployments can still be processed.
+
+    Args:
+        file_path (Path): The absolute path to the deployment script.
     """
     try:
-        logger.info(f"Creating deployment {file_name} ...")
-        subprocess.run(["python3", file_name], check=True)
-        logger.info(f"Successfully completed {file_name} deployment creation")
-    except subprocess.CalledProcessError as e:
-        logger.warning(f"FAILED to create deployment {file_name}")
-        raise e
+        logger.info("Creating deployment %s ...", file_path.name)
+        runpy.run_path(str(file_path), run_name="__main__")
+    except SystemExit as e:
+        # Scripts used to run in their own process, where `sys.exit()` only set the exit
+        # code, so it must not stop the remaining deployments.
+        if e.code not in (0, None):
+            logger.warning(
+                "FAILED to create deployment %s (exit code %s)", file_path.name, e.code
+            )
+            failed_deployments.append(file_path.name)
+            return
+    except Exception:
+        logger.exception("FAILED to create deployment %s", file_path.name)
+        failed_deployments.append(file_path.name)
+        return
+
+    logger.info("Successfully completed %s deployment creation", file_path.name)
+
+
+async def apply_deployments(deployments: List[Deployment]) -> None:
+    """
+    Apply the deployments built from the deployment scripts concurrently.
+
+    Deployments that fail to apply are logged and added to `failed_deployments`.
+
+    Args:
+        deployments (List[Deployment]): The deployments to apply.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_APPLIES)
+    results = await asyncio.gather(
+        *[templates.apply_deployment(d, semaphore) for d in deployments],
+        return_exceptions=True,
+    )
+    for deployment, result in zip(deployments, results):
+        if isinstance(result, Exception):
+            logger.error(
+                "FAILED to apply deployment %s", deployment.name, exc_info=result
+            )
+            failed_deployments.append(deployment.name)
+        else:
+            logger.info("Successfully applied %s deployment", deployment.name)
 
 
 def delete_deployment(deployment_id: str, deployment_name: str) -> None:
     """
-    Delete a deployment with the specified id.
+    Schedule the deletion of a deployment with the specified id.
+
+    The deployment is added to `pending_deletions` and deleted by `delete_deployments()`.
 
     Args:
+        deployment_id (str): The id of the deployment.
         deployment_name (str): The name of the deployment.
+    """
+    logger.info("Deleting deployment %s ...", deployment_name)
+    pending_deletions.append((deployment_id, deployment_name))
 
-    Raises:
-        subprocess.CalledProcessError: If the deployment deletion fails.
+
+async def delete_deployments(client, pairs: List[Tuple[str, str]]) -> None:
     """
-    try:
-        logger.info(f"Deleting deployment {deployment_name} ...")
-        delete_command = ["prefect", "deployment", "delete", "--id", deployment_id]
-        subprocess.run(delete_command, capture_output=True, text=True)
-        logger.info(f"Successfully completed {deployment_name} deployment deleting")
-    except subprocess.CalledProcessError as e:
-        logger.warning(f"FAILED to delete deployment {deployment_name}")
-        raise e
+    Delete deployments concurrently.
 
+    Deployments that fail to be deleted are logged.
+
+    Args:
+        client: The Prefect API client.
+        pairs (List[Tuple[str, str]]): The ids and names of the deployments to delete.
+    """
+    results = await asyncio.gather(
+        *[client.delete_deployment(uuid.UUID(i)) for i, _ in pairs],
+        return_exceptions=True,
+    )
+    for (_, deployment_name), result in zip(pairs, results):
+        if isinstance(result, Exception):
+            logger.warning(
+                "FAILED to delete deployment %s", deployment_name, exc_info=result
+            )
+        else:
+            logger.info(
+                "Successfully completed %s deployment deleting", deployment_name
+            )
+
+
+class GitCatFile:
+    """
+    Persistent `git cat-file --batch-check` process used to look up Git objects without
+    spawning a new `git` process for every query.
+    """
 
-def get_current_branch() -> str:
+    def __enter__(self) -> "GitCatFile":
+        self.p = subprocess.Popen(
+            [
+                "git",
+                "cat-file",
+                "--batch-check=%(objectname) %(objecttype) %(objectsize)",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def query(self, ref: str) -> str:
+        """
+        Look up a Git object.
+
+        Args:
+            ref (str): The object to look up, eg. `HEAD` or `<commit>:<path>`.
+
+        Returns:
+            str: The object's `<objectname> <objecttype> <objectsize>`, or `<ref> missing`
+                if the object does not exist.
+        """
+        self.p.stdin.write(ref + "\n")
+        self.p.stdin.flush()
+        return self.p.stdout.readline().strip()
+
+    def object_id(self, ref: str) -> Optional[str]:
+        """
+        Look up the id of a Git object.
+
+        Args:
+            ref (str): The object to look up, eg. `HEAD` or `<commit>:<path>`.
+
+        Returns:
+            Optional[str]: The id of the object, or None if the object does not exist.
+        """
+        result = self.query(ref)
+        if result.endswith(" missing"):
+            return None
+
+        return result.split()[0]
+
+    def close(self) -> None:
+        """Stop the `git cat-file` process."""
+        self.p.stdin.close()
+        self.p.wait()
+
+
+def get_current_branch(cat_file: GitCatFile) -> str:
     """
     Retrieve the hash of the current branch.
 
+    Args:
+        cat_file (GitCatFile): The `git cat-file` process used to resolve `HEAD`.
+
     Returns:
         str: The hash of the current branch.
+
+    Raises:
+        RuntimeError: If `HEAD` cannot be resolved.
     """
-    current_branch_command = ["git", "rev-parse", "HEAD"]
-    current_branch_result = subprocess.run(
-        current_branch_command, capture_output=True, text=True
-    )
-    current_branch = current_branch_result.stdout.strip()
+    current_branch = cat_file.object_id("HEAD")
+    if current_branch is None:
+        raise RuntimeError("Could not resolve HEAD to a commit")
 
     return current_branch
 
 
-def get_commits(branch: str) -> List[str]:
+async def read_fields(stream: asyncio.StreamReader) -> AsyncIterator[str]:
     """
-    Retrieves the commit hashes for the given branch.
+    Read the NUL-terminated fields of a stream as soon as they are available.
 
     Args:
-        branch (str): The name of the branch.
-        
-    Returns:
-        List[str]: A list of commit hashes.
+        stream (asyncio.StreamReader): The stream to read.
+
+    Yields:
+        str: The fields, decoded the same way the filesystem decodes paths.
     """
-    # Get the commit hashes for the given branch
-    commit_hashes_command = [
-        "git",
-        "rev-list",
-        "--ancestry-path",
-        f"{branch}^..HEAD",
-    ]
-    commit_hashes_result = subprocess.run(
-        commit_hashes_command, capture_output=True, text=True
-    )
-    commit_hashes = commit_hashes_result.stdout.strip().split()
-    return commit_hashes
+    while True:
+        try:
+            field = await stream.readuntil(b"\0")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                yield os.fsdecode(e.partial)
+            return
+        yield os.fsdecode(field[:-1])
 
 
-def get_modified_files(commit: str) -> Dict[str, str]:
+async def read_path(fields: AsyncIterator[str], operation: str) -> str:
     """
-    Get the modified files in a commit.
+    Read the next path of a `git log --name-status -z` entry.
 
     Args:
-        commit (str): The commit hash.
+        fields (AsyncIterator[str]): The fields of the `git log` output.
+        operation (str): The file operation of the entry, eg. `M` or `R100`.
 
     Returns:
-        Dict[str, str]: A dictionary where the keys are the modified file paths and the values are the file operations.
+        str: The path.
+
+    Raises:
+        ValueError: If the output ends before the path.
+    """
+    try:
+        return await fields.__anext__()
+    except StopAsyncIteration:
+        raise ValueError(
+            f"`git log` output ended before the path of a '{operation}' entry"
+        ) from None
+
+
+async def get_all_changes(
+    main: str, branch: str
+) -> AsyncIterator[Tuple[str, Dict[str, str]]]:
+    """
+    Retrieve the modified files of every commit between two revisions using a single `git log` call.
+
+    The output of `git log` is parsed while it is produced, so it is never buffered in full.
+
+    Args:
+        main (str): The revision to start from (excluded).
+        branch (str): The revision to end at (included).
+
+    Yields:
+        Tuple[str, Dict[str, str]]: The commit hash and a dictionary where the keys are the modified
+            file paths and the values are the file operations, from the oldest commit to the newest.
+
+    Raises:
+        subprocess.CalledProcessError: If `git log` fails.
+        ValueError: If the output of `git log` cannot be parsed.
     """
     changed_files_command = [
         "git",
-        "diff-tree",
-        "--no-commit-id",
+        "log",
+        "--reverse",
+        "--no-merges",
+        "--ancestry-path",
+        "-z",
+        "--format=commit %H",
         "--name-status",
-        "-r",
-        commit,
+        f"{main}..{branch}",
     ]
-    changed_files_result = subprocess.run(
-        changed_files_command, capture_output=True, text=True
+    changed_files_process = await asyncio.create_subprocess_exec(
+        *changed_files_command, stdout=asyncio.subprocess.PIPE
     )
 
-    changes = changed_files_result.stdout.strip().split()
-    modified_files = {changes[i + 1]: changes[i] for i in range(0, len(changes), 2)}
-    return modified_files
+    # With `-z`, every field is terminated by NUL, so paths are never quoted or split on
+    # whitespace. Each commit header is followed by a newline before its first status.
+    fields = read_fields(changed_files_process.stdout)
+    commit, modified_files = None, {}
+    try:
+        async for field in fields:
+            field = field.lstrip("\n")
+            if not field:
+                continue
+            if field.startswith("commit "):
+                if commit is not None:
+                    yield commit, modified_files
+                commit, modified_files = field[len("commit ") :], {}
+            elif field[0] in "RC":
+                old_path = await read_path(fields, field)
+                new_path = await read_path(fields, field)
+                if field[0] == "R":
+                    # Renames are reported as a single entry, which the rest of the
+                    # script handles as the removal of the old file and the addition of
+                    # the new one.
+                    modified_files[old_path] = "D"
+                modified_files[new_path] = field[0]
+            else:
+                modified_files[await read_path(fields, field)] = field[0]
+    except ValueError as e:
+        # Output cut short by a failing `git log` is reported as the failure below.
+        if await changed_files_process.wait() == 0:
+            raise e
+
+    # A failing `git log` (eg. `main` missing from a shallow clone) must not be mistaken
+    # for a branch without changes.
+    if await changed_files_process.wait() != 0:
+        raise subprocess.CalledProcessError(
+            changed_files_process.returncode, changed_files_command
+        )
+
+    if commit is not None:
+        yield commit, modified_files
+
+
+async def squash_changes(
+    changes: AsyncIterator[Tuple[str, Dict[str, str]]]
+) -> Dict[str, str]:
+    """
+    Compute the effective operation of every modified file across all the commits.
+
+    The last operation of a file wins, except that:
+    - a file added and later modified is still considered added,
+    - a file deleted and later added again existed before the changes, so it is considered
+      modified,
+    - a file added (that did not exist before the changes) and later deleted is left out.
+
+    Args:
+        changes (AsyncIterator[Tuple[str, Dict[str, str]]]): The modified files of each commit,
+            from the oldest commit to the newest.
+
+    Returns:
+        Dict[str, str]: A dictionary where the keys are the modified file paths and the values are
+            the effective file operations.
+    """
+    final_ops: Dict[str, str] = {}
+    async for _, modified_files in changes:
+        for path, operation in modified_files.items():
+            previous_operation = final_ops.get(path)
+            if previous_operation == "A" and operation == "D":
+                del final_ops[path]
+            elif previous_operation == "A" and operation == "M":
+                continue
+            elif previous_operation == "D" and operation == "A":
+                final_ops[path] = "M"
+            else:
+                final_ops[path] = operation
+
+    return final_ops
+
+
+def drop_unchanged(
+    final_ops: Dict[str, str], cat_file: GitCatFile, main: str, branch: str
+) -> Dict[str, str]:
+    """
+    Drop the modified deployment scripts whose content is the same on both revisions.
+
+    When `branch` is a merge commit, the changes cover every commit of the merged branch, so
+    a script can be modified and later reverted there without any change in the result.
+
+    Args:
+        final_ops (Dict[str, str]): The effective operation of every modified file.
+        cat_file (GitCatFile): The `git cat-file` process used to compare the files.
+        main (str): The revision the changes start from.
+        branch (str): The revision the changes end at.
+
+    Returns:
+        Dict[str, str]: The effective operations, without the unchanged deployment scripts.
+    """
+    return {
+        path: operation
+        for path, operation in final_ops.items()
+        if not (
+            operation == "M"
+            and path.startswith(DEPLOYMENTS_PREFIX)
+            and cat_file.object_id(f"{main}:{path}")
+            == cat_file.object_id(f"{branch}:{path}")
+        )
+    }
+
+
+def create_from_path(
+    path: str, deployments_by_tag: Dict[str, List[Deployment]]
+) -> None:
+    """
+    Create a deployment from an added or modified deployment script.
+
+    Args:
+        path (str): The modified file path.
+        deployments_by_tag (Dict[str, List[Deployment]]): Prefect deployments indexed by tag.
+    """
+    logger.info("Creating deployment from %s", path)
+    file_path = DEPLOYMENTS_DIRECTORY / os.path.basename(path)
+    if file_path.exists():
+        create_deployment(file_path)
+
+
+def delete_from_path(
+    path: str, deployments_by_tag: Dict[str, List[Deployment]]
+) -> None:
+    """
+    Delete the deployments created from a deleted deployment script.
+
+    Args:
+        path (str): The modified file path.
+        deployments_by_tag (Dict[str, List[Deployment]]): Prefect deployments indexed by tag.
+    """
+    logger.info("Deleting deployment from %s", path)
+    for deployment in deployments_by_tag.get(os.path.basename(path), ()):
+        delete_deployment(str(deployment.id), deployment.name)
+
+
+# Handler of a modified deployment script, by file operation.
+OPERATION_HANDLERS = {
+    **dict.fromkeys(CREATE_OPERATIONS, create_from_path),
+    "D": delete_from_path,
+}
 
 
 def visit_deployment(
     path: str,
     operation: str,
-    prefect_deployments: List[Deployment],
-    script_directory: str,
+    deployments_by_tag: Dict[str, List[Deployment]],
 ) -> None:
     """
     Visit a deployment based on the modified file path and based operation create or delete the deployment.
@@ -168,48 +506,65 @@ def visit_deployment(
     Args:
         path (str): The modified file path.
         operation (str): The file operation ('A', 'M', 'R', 'C', or 'D').
-        prefect_deployments (List[Deployment]): A list of Prefect deployments.
-        script_directory (str): The directory of the deployment scripts.
-    """
-    os.chdir(script_directory)
-    file_name = os.path.basename(path)
-
-    if path.startswith("prefect/flows/deployments/") and operation in [
-        "A",
-        "M",
-        "R",
-        "C",
-    ]:
-        logger.info(f"Creating deployment from {path}")
-        os.chdir("../../prefect/flows/deployments/")
-        if os.path.exists(file_name):
-            create_deployment(file_name)
-
-    elif path.startswith("prefect/flows/deployments/") and operation == "D":
-        logger.info(f"Deleting deployment from {path}")
-        for deployment in prefect_deployments:
-            if file_name in deployment.tags:
-                delete_deployment(str(deployment.id), deployment.name)         
-
-branch = get_current_branch()
-
-commits = get_commits(branch=branch)
-
-# Reverse the list of commits to ensure operations are performed in the same order as the user did
-inverted_list = reversed(commits)
-
-loop = asyncio.get_event_loop()
-prefect_deployments = loop.run_until_complete(get_prefect_deployments())
-loop.close()
-script_directory = os.getcwd()
-
-visited = []
-
-# Iterate over commit hashes
-for commit in inverted_list:
-    modified_files = get_modified_files(commit)
-
-    for path, operation in modified_files.items():
-        if path not in visited:
-            visit_deployment(path, operation, prefect_deployments, script_directory)
-            visited.append(path)
\ No newline at end of file
+        deployments_by_tag (Dict[str, List[Deployment]]): Prefect deployments indexed by tag.
+    """
+    handler = OPERATION_HANDLERS.get(operation)
+    if handler and path.startswith(DEPLOYMENTS_PREFIX):
+        handler(path, deployments_by_tag)
+
+
+async def main() -> None:
+    """Create and delete Prefect deployments based on the files modified on the current branch."""
+    # A single client (and so a single connection pool) is used for all the requests made
+    # from the event loop.
+    async with get_prefect_client() as client:
+        with GitCatFile() as cat_file:
+            branch = get_current_branch(cat_file)
+            main_revision = f"{branch}^"
+
+            final_ops, prefect_deployments = await asyncio.gather(
+                squash_changes(get_all_changes(main=main_revision, branch=branch)),
+                get_prefect_deployments(client),
+            )
+            # Modified deployment scripts that are back to their original content need
+            # no new deployment.
+            final_ops = drop_unchanged(
+                final_ops, cat_file, main=main_revision, branch=branch
+            )
+
+            deployments_by_tag: Dict[str, List[Deployment]] = {}
+            for deployment in prefect_deployments:
+                for tag in deployment.tags:
+                    deployments_by_tag.setdefault(tag, []).append(deployment)
+
+            # Prefect uploads the working directory, filtered by its `.prefectignore`,
+            # both when building and when applying a deployment, so both must run from
+            # the deployments directory, as the deployment scripts originally did.
+            with working_directory(DEPLOYMENTS_DIRECTORY):
+                # Deployments built by the scripts are collected and applied together
+                # at the end
+                with templates.collect_deployments() as pending_deployments:
+                    for path, operation in final_ops.items():
+                        # Deployment scripts call Prefect's sync-compatible API, which
+                        # must not run on the event loop's thread.
+                        await asyncio.to_thread(
+                            visit_deployment,
+                            path,
+                            operation,
+                            deployments_by_tag,
+                        )
+
+                # Deployments are upserted on their flow and name, so an applied deployment
+                # can keep the id of one to delete (eg. when its script is renamed).
+                # Deleting first ensures the applied deployment is the one left.
+                await delete_deployments(client, pending_deletions)
+                await apply_deployments(pending_deployments)
+
+    if failed_deployments:
+        raise RuntimeError(
+            f"Failed to create or apply deployments: {', '.join(failed_deployments)}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
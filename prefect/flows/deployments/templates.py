@@ -2,15 +2,74 @@
 Templates for Prefect deployments. 
 """
 
+import asyncio
+import contextlib
+import functools
 import importlib
 import os
 import pathlib
+import sys
+from types import MappingProxyType
+from typing import Iterator, Optional
 
-import __main__
+from dotenv import load_dotenv
+from prefect import Flow
 from prefect.blocks.core import Block
 from prefect.deployments import Deployment
 from prefect.orion.schemas.schedules import CronSchedule
 
+# Deployment scripts import the templates before loading their `.env` file, so load it
+# here for the defaults below.
+load_dotenv()
+
+# Default deployment settings, resolved once when the templates are imported.
+DEFAULT_INFRA_BLOCK = os.environ.get("NESSO_PREFECT_DEFAULT_INFRA_BLOCK")
+DEFAULT_STORAGE_BLOCK = os.environ.get("NESSO_PREFECT_DEFAULT_STORAGE_BLOCK")
+DEFAULT_WORK_POOL = os.environ.get("NESSO_PREFECT_DEFAULT_WORK_POOL")
+DEFAULT_WORK_QUEUE = os.environ.get("NESSO_PREFECT_DEFAULT_WORK_QUEUE")
+DEFAULT_SCHEDULE_TIMEZONE = os.environ.get("NESSO_PREFECT_DEFAULT_SCHEDULE_TIMEZONE")
+
+# Deployments built by `extract_and_load()` while `collect_deployments()` is active.
+_collected_deployments: Optional[list[Deployment]] = None
+
+
+@functools.lru_cache(maxsize=None)
+def _load_flow(flow_name: str, is_flow_custom: bool) -> tuple[Flow, str]:
+    """
+    Import a flow, caching it so that deployments of the same flow import it only once.
+
+    Args:
+        flow_name (str): Name of the flow.
+        is_flow_custom (bool): Whether flow is custom or pre-defined.
+
+    Returns:
+        tuple[Flow, str]: The flow and its entrypoint, in the `<file_path>:<function_name>`
+            format.
+    """
+    if is_flow_custom:
+        flow_module = importlib.import_module(f"custom.{flow_name}")
+    else:
+        flow_module = importlib.import_module(f"prefect_viadot.flows.{flow_name}")
+    flow = getattr(flow_module, flow_name)
+    flow_filepath = getattr(flow_module, "__file__", None)
+    entrypoint = f"{flow_filepath}:{flow.fn.__name__}"
+
+    return flow, entrypoint
+
+
+@functools.lru_cache(maxsize=None)
+def _load_block(name: str) -> Block:
+    """
+    Load a block, caching it so that deployments using the same block load it only once.
+
+    Args:
+        name (str): Name of the block, in the `<block_type>/<block_name>` format.
+
+    Returns:
+        Block: The loaded block.
+    """
+    return Block.load(name)
+
 
 def get_deployment(
     name: str,
@@ -62,42 +121,33 @@ def get_deployment(
     Returns:
         Deployment: Prefect deployment that stores flow's metadata.
     """
-    if is_flow_custom:
-        flow_module = importlib.import_module(f"custom.{flow_name}")
-        flow = getattr(flow_module, flow_name)
-        flow_filepath = getattr(flow_module, "__file__", None)
-    else:
-        flow_module = importlib.import_module(f"prefect_viadot.flows.{flow_name}")
-        flow = getattr(flow_module, flow_name)
-        flow_filepath = getattr(flow_module, "__file__", None)
+    flow, entrypoint = _load_flow(flow_name, is_flow_custom)
 
     if infra_block is None:
-        infra_block = os.environ.get("NESSO_PREFECT_DEFAULT_INFRA_BLOCK")
+        infra_block = DEFAULT_INFRA_BLOCK
 
     if storage_block is None:
-        storage_block = os.environ.get("NESSO_PREFECT_DEFAULT_STORAGE_BLOCK")
+        storage_block = DEFAULT_STORAGE_BLOCK
 
     if work_pool is None:
-        work_pool = os.environ.get("NESSO_PREFECT_DEFAULT_WORK_POOL")
+        work_pool = DEFAULT_WORK_POOL
 
     if work_queue is None:
-        work_queue = os.environ.get("NESSO_PREFECT_DEFAULT_WORK_QUEUE")
+        work_queue = DEFAULT_WORK_QUEUE
 
     if schedule:
         if schedule_timezone is None:
-            schedule_timezone = os.environ.get(
-                "NESSO_PREFECT_DEFAULT_SCHEDULE_TIMEZONE"
-            )
+            schedule_timezone = DEFAULT_SCHEDULE_TIMEZONE
 
         schedule = CronSchedule(cron=schedule, timezone=schedule_timezone)
 
-    infrastructure = Block.load(infra_block)
-    storage = Block.load(storage_block)
+    infrastructure = _load_block(infra_block)
+    storage = _load_block(storage_block)
 
     deployment = Deployment.build_from_flow(
         flow=flow,
         name=name,
-        entrypoint=f"{flow_filepath}:{flow.fn.__name__}",
+        entrypoint=entrypoint,
         parameters=params,
         schedule=schedule,
         work_pool_name=work_pool,
@@ -111,7 +161,7 @@ def get_deployment(
     return deployment
 
 
-def extract_and_load(
+def build_deployment(
     name: str,
     flow_name: str,
     is_flow_custom: bool = False,
@@ -124,9 +174,9 @@ def extract_and_load(
     storage_block: str = None,
     version: int = 1,
     tags: list[str] = [],
-) -> None:
+) -> Deployment:
     """
-    Build and apply the Prefect deployment.
+    Build the Prefect deployment with the default flow parameters, without applying it.
 
     Args:
         name (str): Name of the deployment.
@@ -157,6 +207,9 @@ def extract_and_load(
             variable.
         version (int, optional): Version of the deployment. Defaults to 1.
         tags (list[str], optional): List of tags for the deployment. Defaults to [].
+
+    Returns:
+        Deployment: Prefect deployment that stores flow's metadata.
     """
 
     params = params or {}
@@ -176,7 +229,111 @@ def extract_and_load(
         version=version,
         tags=tags,
     )
-    deployment.apply(upload=True)
+
+    return deployment
+
+
+async def apply_deployment(
+    deployment: Deployment, semaphore: asyncio.Semaphore = None
+) -> None:
+    """
+    Apply a Prefect deployment without blocking the event loop.
+
+    Args:
+        deployment (Deployment): The deployment to apply.
+        semaphore (asyncio.Semaphore, optional): Semaphore limiting the number of
+            deployments applied concurrently. Defaults to None.
+    """
+    async with semaphore or contextlib.nullcontext():
+        await asyncio.to_thread(deployment.apply, upload=True)
+
+
+@contextlib.contextmanager
+def collect_deployments() -> Iterator[list[Deployment]]:
+    """
+    Collect the deployments built by `extract_and_load()` instead of applying them.
+
+    Yields:
+        list[Deployment]: The deployments built while the context is active.
+    """
+    global _collected_deployments
+
+    _collected_deployments = []
+    try:
+        yield _collected_deployments
+    finally:
+        _collected_deployments = None
+
+
+def extract_and_load(
+    name: str,
+    flow_name: str,
+    is_flow_custom: bool = False,
+    params: dict = None,
+    schedule: str = None,
+    schedule_timezone: str = None,
+    work_pool: str = None,
+    work_queue: str = None,
+    infra_block: str = None,
+    storage_block: str = None,
+    version: int = 1,
+    tags: list[str] = [],
+) -> None:
+    """
+    Build and apply the Prefect deployment.
+
+    If called while `collect_deployments()` is active, the deployment is only built and
+    added to the collected deployments, to be applied by the caller.
+
+    Args:
+        name (str): Name of the deployment.
+        flow_name (str): Name of the flow.
+        is_flow_custom (bool): Whether flow is custom or pre-defined. If True,
+            deployment will reference the flow from
+            '$NESSO_REPO_HOME/prefect/flows/custom'. If False, the deployment
+            will reference the flow from 'prefect_viadot.flows' package.
+            Defaults to False.
+        params (dict, optional): Dictionary of parameters for flow runs scheduled
+            by the deployment. Defaults to None.
+        schedule (str, optional): Schedule for the deployment defined using
+            the cron string format. Defaults to None.
+        schedule_timezone (str, optional): The timezone for the schedule. Defaults
+            to the value of the `NESSO_PREFECT_DEFAULT_SCHEDULE_TIMEZONE` environment
+            variable.
+        work_pool (str, optional): Work pool that will handle the deployment's run.
+            Defaults to the value of the `NESSO_PREFECT_DEFAULT_WORK_POOL` environment
+            variable.
+        work_queue (str, optional): Work queue that will handle the deployment's run.
+            Defaults to the value of the `NESSO_PREFECT_DEFAULT_WORK_QUEUE` environment
+            variable.
+        infra_block (str, optional): Infrastructure block configured for the deployment.
+            Defaults to the value of the `NESSO_PREFECT_DEFAULT_INFRA_BLOCK` environment
+            variable.
+        storage_block (str, optional): Storage block configured for the deployment.
+            Defaults to the value of the `NESSO_PREFECT_DEFAULT_STORAGE_BLOCK` environment
+            variable.
+        version (int, optional): Version of the deployment. Defaults to 1.
+        tags (list[str], optional): List of tags for the deployment. Defaults to [].
+    """
+    deployment = build_deployment(
+        name=name,
+        flow_name=flow_name,
+        is_flow_custom=is_flow_custom,
+        params=params,
+        schedule=schedule,
+        schedule_timezone=schedule_timezone,
+        work_pool=work_pool,
+        work_queue=work_queue,
+        infra_block=infra_block,
+        storage_block=storage_block,
+        version=version,
+        tags=tags,
+    )
+
+    if _collected_deployments is not None:
+        _collected_deployments.append(deployment)
+    else:
+        deployment.apply(upload=True)
 
 
 def extract_and_load_custom(
@@ -188,7 +345,9 @@ def extract_and_load_custom(
     params.update(**kwargs)
 
     extract_and_load(
-        name=pathlib.Path(__main__.__file__).stem,
+        # Looked up at call time, as deployment scripts may be run with `runpy`, which
+        # replaces `__main__` only for the duration of the script.
+        name=pathlib.Path(sys.modules["__main__"].__file__).stem,
         flow_name=flow_name,
         is_flow_custom=True,
         params=params,
@@ -200,4 +359,6 @@ def extract_and_load_custom(
 # `extract_and_load()` deployment template.
 bucket = os.getenv("NESSO_BUCKET_NAME")
 schema_name = os.getenv("NESSO_LANDING_SCHEMA")
-EXTRACT_DEFAULT_PARAMS = {"to_path": f"s3://{bucket}/nesso/{schema_name}"}
+EXTRACT_DEFAULT_PARAMS = MappingProxyType(
+    {"to_path": f"s3://{bucket}/nesso/{schema_name}"}
+)